@@ -1,235 +1,785 @@
 import streamlit as st
-import pysrt
-from googletrans import Translator
+import httpx
+import charset_normalizer
 import io
+import codecs
 import os
 import time
 import re
 from datetime import datetime
 import zipfile
-import random
+import asyncio
 import queue
 import threading
-from typing import List, Dict, Any
+import sqlite3
+import hashlib
+import importlib.util
+from collections import OrderedDict
+from array import array
+from typing import List
+
+TRANSLATE_URL = "https://translate.googleapis.com/translate_a/single"
+
+# HTTP/2 cần gói h2 (httpx[http2]) - thiếu thì dùng HTTP/1.1 keep-alive
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Số request dịch chạy song song tối đa - tính chung cho mọi file đang dịch
+MAX_CONCURRENT_REQUESTS = 16
+
+# Giới hạn tốc độ chủ động: trung bình 5 request/giây, tối đa 20 request dồn
+REQUESTS_PER_SECOND = 5.0
+REQUEST_BURST = 20
+MAX_RETRY_AFTER = 60  # giây - giới hạn thời gian tạm dừng theo header Retry-After
+
+# Gộp nhiều dòng vào một request, ngăn cách bằng tag đánh số
+MAX_BATCH_CHARS = 4500
+BATCH_TAG_FORMAT = "\n<<{:04d}>>\n"
+BATCH_TAG_OVERHEAD = len(BATCH_TAG_FORMAT.format(0))
+_BATCH_TAG_RE = re.compile(r'\s*<<\s*\d{4}\s*>>\s*')
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Dòng không có chữ (♪, số, dấu câu) hoặc chỉ là URL - không cần dịch
+_SKIP_RE = re.compile(r'^(?:[\W\d_]+|(?:https?://|www\.)\S+)$', re.I)
+# Chữ cái chỉ tiếng Việt mới dùng: ơ, ư, nguyên âm dấu nặng/dấu hỏi và dấu thanh trên â/ê/ô/ă.
+# Không tính â, ê, ô, à, é (Pháp, Bồ Đào Nha), ă (Rumani), đ (Croatia, Serbia), ẽ, ỹ (Guarani), ỳ
+_VI_ONLY_CHARS_RE = re.compile(r'[ơưạảấầẩẫậắằẳẵặẹẻếềểễệỉịọỏốồổỗộớờởỡợụủứừửữựỵỷ]', re.I)
+MIN_DETECT_LENGTH = 20  # dòng ngắn hơn thì nhận diện không đáng tin
+# Một âm tiết tiếng Việt: phụ âm đầu + 1-3 nguyên âm + phụ âm cuối. Từ tiếng Anh như
+# "have", "and", "ordered" không khớp - tên riêng tiếng Việt trong câu tiếng Anh thì khớp
+_VI_VOWELS = 'aàáảãạăằắẳẵặâầấẩẫậeèéẻẽẹêềếểễệiìíỉĩịoòóỏõọôồốổỗộơờớởỡợuùúủũụưừứửữựyỳýỷỹỵ'
+_VI_SYLLABLE_RE = re.compile(
+    r'(?:ngh|ng|nh|ch|gh|gi|kh|ph|qu|th|tr|[bcdđghklmnprstvx])?[%s]{1,3}(?:ng|nh|ch|[cmnpt])?' % _VI_VOWELS
+)
+_WORD_RE = re.compile(r'[^\W\d_]+')
+MIN_DETECT_WORDS = 3  # số từ (không tính tên riêng) tối thiểu để nhận diện
+MIN_VI_SYLLABLE_SHARE = 0.9  # tỷ lệ từ là âm tiết tiếng Việt hợp lệ
+MIN_VI_ONLY_WORD_SHARE = 0.25  # tỷ lệ từ chứa chữ chỉ-tiếng-Việt
+# Tag bao ngoài dòng phụ đề (<i>, <b>, <font ...>) và khoảng trắng đầu/cuối - giữ nguyên,
+# chỉ dịch phần bên trong (dòng chỉ khác nhau ở khoảng trắng dùng chung một bản dịch)
+# Gồm cả tag điều khiển kiểu ASS ({\an8}, {\i1}) mà nhiều file SRT mang theo
+_WRAP_TAG_RE = re.compile(r'^(\s*(?:(?:<[^>]+>|\{\\[^}]*\})\s*)*)(.*?)(\s*(?:(?:<[^>]+>|\{\\[^}]*\})\s*)*)$', re.S)
+
+# Một cue SRT: dòng thời gian (bỏ qua số thứ tự phía trên) + các dòng nội dung không trống
+# phía sau. Nội dung dừng trước (số thứ tự +) dòng thời gian kế tiếp - file thiếu dòng trống
+# giữa các cue vẫn tách đúng
+_SRT_CUE_RE = re.compile(
+    r'^[ \t]*(\d+):(\d\d):(\d\d)[,.](\d+)[ \t]*-->[ \t]*(\d+):(\d\d):(\d\d)[,.](\d+)[^\n]*(?:\n|\Z)'
+    r'((?:(?![ \t]*(?:\d+[ \t]*\n[ \t]*)?\d+:\d\d:\d\d[,.]\d+[ \t]*-->)[ \t]*\S[^\n]*(?:\n|\Z))*)',
+    re.M
+)
+
+# Dòng thời gian trên bytes thô - dùng cho số liệu tóm tắt lúc upload, không cần giải mã
+_TIMING_BYTES_RE = re.compile(
+    rb'(\d+):(\d\d):(\d\d)[,.](\d+)[ \t]*-->[ \t]*(\d+):(\d\d):(\d\d)[,.](\d+)'
+)
+
+_SRT_CUE_FORMAT = "%d\n%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d\n%s\n"
+
+# Giới hạn tần suất cập nhật tiến trình trên giao diện
+UI_UPDATE_EVERY = 25  # dòng
+UI_UPDATE_INTERVAL = 0.25  # giây
+UI_RENDER_INTERVAL = 0.2  # giây - nhịp vẽ lại widget tiến độ trên thread của script
+
+# ZIP tổng nhỏ hơn ngưỡng này thì không nén
+ZIP_STORE_THRESHOLD = 2 * 1024 * 1024  # 2 MB
+ZIP_DATE_TIME = (2024, 1, 1, 0, 0, 0)  # cố định: cùng nội dung luôn cho cùng file ZIP
+
+# Số file upload giữ số liệu tóm tắt (cache theo file_id) - tránh phình RAM theo số lần upload
+UPLOAD_SUMMARY_CACHE_SIZE = 256
+
+# Cache bản dịch trên đĩa
+CACHE_PATH = os.path.expanduser("~/.srt_translate_cache.db")
+CACHE_TTL_SECONDS = 60 * 60 * 24 * 30  # 30 ngày
+MEMORY_CACHE_SIZE = 50000  # số bản dịch giữ trong RAM
+CACHE_FLUSH_EVERY = 200  # ghi xuống đĩa theo lô để tránh fsync từng dòng
+CACHE_LOCK_CHUNK = 1000  # số dòng tra RAM mỗi lần giữ lock trong get_many
+CACHE_QUERY_CHUNK = 500  # số key mỗi câu SELECT ... IN (...) (SQLite cũ giới hạn 999 tham số)
+
+class TranslationCache:
+    """Cache bản dịch lưu trên đĩa (SQLite), key = md5(text) + ngôn ngữ đích
+    
+    Phía trước có một lớp LRU trong RAM dùng chung cho mọi file và mọi lần rerun.
+    Lock của RAM chỉ giữ trong lúc thao tác dict; đọc/ghi SQLite dùng lock riêng và chạy
+    trong thread pool, nên set_many() trên event loop không phải chờ đĩa.
+    """
+    
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL_SECONDS, memory_size=MEMORY_CACHE_SIZE):
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        # Streamlit chạy mỗi lần rerun trên thread khác - kết nối SQLite có lock riêng
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL: ghi theo lô không chặn đọc, NORMAL: không fsync mỗi commit (cache mất được)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+    
+    @staticmethod
+    def make_key(text, target_language):
+        """Tạo key cache từ nội dung và ngôn ngữ đích"""
+        return hashlib.md5(text.encode('utf-8')).hexdigest() + ":" + target_language
+    
+    def _remember(self, text, target_language, translated):
+        """Đưa bản dịch vào LRU trong RAM (gọi khi đang giữ lock)"""
+        self._memory[(text, target_language)] = translated
+        self._memory.move_to_end((text, target_language))
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+    
+    def get_many(self, texts, target_language):
+        """Tra cả danh sách, trả về dict {text: bản dịch} các dòng có cache (gọi từ thread pool)"""
+        results = {}
+        misses = []
+        # Nhả lock sau mỗi lô để set_many() trên event loop không phải chờ cả file
+        for start in range(0, len(texts), CACHE_LOCK_CHUNK):
+            with self._lock:
+                for text in texts[start:start + CACHE_LOCK_CHUNK]:
+                    hit = self._memory.get((text, target_language))
+                    if hit is None:
+                        misses.append(text)
+                    else:
+                        self._memory.move_to_end((text, target_language))
+                        results[text] = hit
+        if not misses:
+            return results
+        
+        # Tính md5 ngoài lock
+        missing = {self.make_key(text, target_language): text for text in misses}
+        
+        # Bản dịch đã rời LRU nhưng chưa kịp ghi (hoặc đang ghi) xuống đĩa
+        with self._lock:
+            for key in list(missing):
+                row = self._pending.get(key) or self._flushing.get(key)
+                if row is not None:
+                    results[missing.pop(key)] = row[0]
+        if not missing:
+            return results
+        
+        # Đọc SQLite theo lô IN (...) - không giữ lock của RAM trong lúc chờ đĩa
+        keys = list(missing)
+        min_created_at = time.time() - self.ttl
+        rows = []
+        with self._db_lock:
+            for start in range(0, len(keys), CACHE_QUERY_CHUNK):
+                chunk = keys[start:start + CACHE_QUERY_CHUNK]
+                rows.extend(self._conn.execute(
+                    "SELECT key, value FROM translations WHERE created_at > ? AND key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    [min_created_at, *chunk]
+                ).fetchall())
+        
+        for start in range(0, len(rows), CACHE_LOCK_CHUNK):
+            with self._lock:
+                for key, value in rows[start:start + CACHE_LOCK_CHUNK]:
+                    text = missing[key]
+                    results[text] = value
+                    self._remember(text, target_language, value)
+        return results
+    
+    def set_many(self, pairs, target_language):
+        """Lưu các cặp (text, bản dịch) vào RAM - ghi đĩa được gom lại, gọi flush() khi flush_due()"""
+        now = time.time()
+        with self._lock:
+            for text, translated in pairs:
+                self._remember(text, target_language, translated)
+                self._pending[self.make_key(text, target_language)] = (translated, now)
+    
+    def flush_due(self):
+        """Đã đủ một lô bản dịch chờ ghi xuống đĩa"""
+        return len(self._pending) >= CACHE_FLUSH_EVERY
+    
+    def flush(self):
+        """Ghi các bản dịch đang chờ trong một transaction (gọi từ thread pool)"""
+        with self._db_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO translations (key, value, created_at) VALUES (?, ?, ?)",
+                    [(key, value, created_at) for key, (value, created_at) in self._flushing.items()]
+                )
+                self._conn.commit()
+            except Exception:
+                # Ghi lỗi - trả lại hàng chờ để lần flush sau thử lại
+                with self._lock:
+                    for key, row in self._flushing.items():
+                        self._pending.setdefault(key, row)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+@st.cache_resource
+def get_translation_cache():
+    """Một kết nối cache dùng chung cho mọi lần rerun của Streamlit"""
+    try:
+        return TranslationCache()
+    except sqlite3.Error:
+        # Thư mục home không ghi được hoặc không hỗ trợ WAL - chỉ cache trong RAM
+        return TranslationCache(path=':memory:')
+
+class TokenBucket:
+    """Token bucket bất đồng bộ điều chỉnh theo AIMD
+    
+    Bị chặn thì giảm một nửa tốc độ, mỗi request thành công tăng lại một bước nhỏ.
+    """
+    
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=REQUEST_BURST, min_rate=0.5, rate_step=0.05):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate_step = rate_step
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.last_adjust = 0.0
+    
+    def _refill(self):
+        """Nạp token theo thời gian đã trôi qua"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+    
+    async def acquire(self):
+        """Giữ chỗ một token rồi ngủ đúng một lần cho đến lượt của mình"""
+        # Chỉ chạy trên một event loop và không có await giữa đọc và ghi - không cần lock.
+        # Token có thể âm: mỗi request xếp hàng sau các request đã giữ chỗ trước đó
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+    
+    def reward(self):
+        """Request thành công - tăng tốc độ thêm một bước"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.rate + self.rate_step, self.max_rate)
+    
+    def penalize(self, retry_after=None):
+        """Bị rate limit / quá tải - giảm một nửa tốc độ, tạm dừng theo Retry-After nếu có"""
+        now = time.monotonic()
+        # Nhiều request song song cùng nhận 429 chỉ tính là một lần
+        if now - self.last_adjust >= 1:
+            self.rate = max(self.rate * 0.5, self.min_rate)
+            # Bỏ phần burst còn lại nhưng giữ nguyên các chỗ đã đặt trước
+            self.tokens = min(self.tokens, 0)
+            self.last_adjust = now
+        
+        # Server báo thời gian chờ - request kế tiếp chỉ được đi sau khoảng đó
+        if retry_after:
+            self._refill()
+            self.tokens = min(self.tokens, -retry_after * self.rate)
 
 class SmartTranslator:
     """Translator thông minh với khả năng tránh rate limit"""
     
-    def __init__(self):
-        self.translators = []
-        self.current_translator_index = 0
-        self.request_counts = {}
-        self.last_request_times = {}
-        self.max_requests_per_minute = 45
-        self.min_delay_between_requests = 0.08
-        
-        # Tạo nhiều translator instance
-        for i in range(4):  # Giảm xuống 4 để ổn định hơn
-            translator = Translator()
-            self.translators.append(translator)
-            self.request_counts[i] = 0
-            self.last_request_times[i] = 0
-    
-    def get_next_translator(self):
-        """Lấy translator tiếp theo theo round-robin"""
-        self.current_translator_index = (self.current_translator_index + 1) % len(self.translators)
-        return self.translators[self.current_translator_index], self.current_translator_index
-    
-    def should_wait(self, translator_index):
-        """Kiểm tra xem có cần đợi không"""
-        current_time = time.time()
-        last_request = self.last_request_times[translator_index]
-        
-        # Đợi tối thiểu giữa các request
-        if current_time - last_request < self.min_delay_between_requests:
-            return True
-        
-        # Reset counter mỗi phút
-        if current_time - last_request > 60:
-            self.request_counts[translator_index] = 0
-        
-        # Kiểm tra rate limit
-        if self.request_counts[translator_index] >= self.max_requests_per_minute:
-            return True
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.client = None
+        self.bucket = TokenBucket()
+        # Giới hạn số request HTTP đang bay dùng chung cho mọi file
+        self.request_sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # (text, ngôn ngữ) -> Future của dòng đang được dịch: file khác gặp cùng dòng chờ chung
+        self.in_flight = {}
+    
+    async def __aenter__(self):
+        # Một kết nối TCP+TLS, các request chạy song song qua HTTP/2 multiplexing
+        # Số kết nối khớp số request song song; giữ kết nối sống qua các lần tạm dừng Retry-After
+        self.client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=15,
+            headers={"User-Agent": "Mozilla/5.0"},
+            params={'client': 'gtx', 'sl': 'auto', 'dt': 't'},
+            limits=httpx.Limits(
+                max_connections=MAX_CONCURRENT_REQUESTS,
+                max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+                keepalive_expiry=MAX_RETRY_AFTER
+            )
+        )
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.aclose()
+        self.client = None
+    
+    async def request_translation(self, text, target_language='vi'):
+        """Gọi thẳng endpoint của Google Translate (endpoint googletrans dùng)"""
+        # POST để text dài của batch không vượt giới hạn độ dài URL
+        response = await self.client.post(
+            TRANSLATE_URL,
+            params={'tl': target_language},
+            data={'q': text}
+        )
+        response.raise_for_status()
         
-        return False
+        # Kết quả là mảng các đoạn [bản dịch, bản gốc, ...]
+        return "".join(segment[0] for segment in response.json()[0] if segment[0])
     
-    def translate_with_smart_retry(self, text, target_language='vi', max_retries=3):
-        """Dịch với retry thông minh"""
-        for attempt in range(max_retries):
-            translator, translator_index = self.get_next_translator()
-            
-            # Đợi nếu cần
-            while self.should_wait(translator_index):
-                time.sleep(0.1)
-                translator, translator_index = self.get_next_translator()
+    async def translate_with_smart_retry(self, text, target_language='vi', max_retries=3):
+        """Dịch với retry thông minh, trả về None nếu vẫn lỗi sau khi đã retry"""
+        # Không tra cache ở đây - translate_texts_concurrent đã tra cả file bằng get_many
+        for _ in range(max_retries):
+            await self.bucket.acquire()
             
             try:
-                current_time = time.time()
-                result = translator.translate(text, dest=target_language)
-                
-                # Cập nhật thống kê
-                self.request_counts[translator_index] += 1
-                self.last_request_times[translator_index] = current_time
-                
-                return result.text
+                # Giữ chỗ theo từng request HTTP - batch chia đôi hay dòng dài chia đoạn
+                # cũng không vượt quá số request song song (và số kết nối của pool)
+                async with self.request_sem:
+                    translated = await self.request_translation(text, target_language)
+                self.bucket.reward()
+                return translated
                 
             except Exception as e:
-                if "429" in str(e) or "rate" in str(e).lower():
-                    # Rate limit - chuyển sang translator khác
-                    self.request_counts[translator_index] = self.max_requests_per_minute
-                    if attempt < max_retries - 1:
-                        time.sleep(random.uniform(0.5, 1.5))
-                        continue
-                elif attempt < max_retries - 1:
-                    # Lỗi khác - retry với delay ngẫu nhiên
-                    time.sleep(random.uniform(0.2, 0.8))
-                    continue
-                else:
-                    return text
-        
-        return text
-
-def translate_batch_sequential(texts: List[str], smart_translator: SmartTranslator, target_language='vi'):
-    """Dịch batch tuần tự nhưng với tốc độ tối ưu"""
-    results = {}
+                # 429, lỗi 5xx, lỗi kết nối/timeout: server đang quá tải - giảm tốc
+                is_overloaded = (
+                    isinstance(e, httpx.HTTPStatusError)
+                    and (e.response.status_code == 429 or e.response.status_code >= 500)
+                ) or isinstance(e, httpx.TransportError) or "rate" in str(e).lower()
+                
+                # Không sleep cố định - lần thử sau vẫn phải chờ token từ bucket
+                if is_overloaded:
+                    retry_after = None
+                    if isinstance(e, httpx.HTTPStatusError):
+                        value = e.response.headers.get('Retry-After', '')
+                        if value.isdigit():
+                            retry_after = min(int(value), MAX_RETRY_AFTER)
+                    self.bucket.penalize(retry_after)
+        
+        return None
+
+def is_already_target_language(text, target_language='vi'):
+    """Dòng đã ở ngôn ngữ đích (phụ đề đã Việt hóa một phần) - không cần gửi đi dịch
+
+    Quyết định theo tỷ lệ từ, bỏ qua từ viết hoa giữa câu (tên người, tên món ăn) -
+    câu tiếng Anh nhắc tên tiếng Việt vẫn được dịch:
+
+    >>> is_already_target_language("Have you met Nguyễn Thị Hương yet?")
+    False
+    >>> is_already_target_language("I ordered phở and bánh mì at Phở Hương.")
+    False
+    >>> is_already_target_language("Tôi không biết anh ấy ở đâu cả.")
+    True
+    >>> is_already_target_language("Anh Nguyễn Văn Nam đến rồi à?")
+    True
+    """
+    if target_language != 'vi' or len(text) < MIN_DETECT_LENGTH:
+        return False
+    # Phần lớn dòng không có chữ chỉ-tiếng-Việt - trả về ngay, không tách từ
+    if not _VI_ONLY_CHARS_RE.search(text):
+        return False
+    
+    words = [word.lower() for i, word in enumerate(_WORD_RE.findall(text))
+             if i == 0 or not word[0].isupper()]
+    if len(words) < MIN_DETECT_WORDS:
+        return False
+    
+    syllables = sum(1 for word in words if _VI_SYLLABLE_RE.fullmatch(word))
+    vi_only = sum(1 for word in words if _VI_ONLY_CHARS_RE.search(word))
+    return (syllables >= MIN_VI_SYLLABLE_SHARE * len(words)
+            and vi_only >= MIN_VI_ONLY_WORD_SHARE * len(words))
+
+def is_translatable(text):
+    """Dòng có chữ cần dịch: không rỗng, không chỉ gồm ký hiệu/số/URL, chưa ở ngôn ngữ đích"""
+    # _SKIP_RE đã bao gồm dòng chỉ có khoảng trắng - không cần strip()
+    return bool(text) and not _SKIP_RE.match(text) and not is_already_target_language(text)
+
+def split_markup(text):
+    """Tách text thành (tag mở, nội dung, tag đóng)"""
+    return _WRAP_TAG_RE.match(text).groups()
+
+def split_text_into_chunks(text, max_length=MAX_BATCH_CHARS):
+    """Chia text dài thành các đoạn theo câu, mỗi đoạn không quá max_length ký tự"""
+    chunks = []
+    parts = []
+    current_len = 0
+    
+    for sentence in _SENT_RE.split(text):
+        # Câu dài hơn cả một đoạn (lời bài hát không dấu câu...) - cắt tại khoảng trắng
+        while len(sentence) > max_length:
+            if parts:
+                chunks.append(" ".join(parts))
+                parts = []
+                current_len = 0
+            cut = sentence.rfind(' ', 0, max_length)
+            if cut <= 0:
+                cut = max_length
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        
+        sentence_len = len(sentence) + 1
+        if parts and current_len + sentence_len > max_length:
+            chunks.append(" ".join(parts))
+            parts = []
+            current_len = 0
+        parts.append(sentence)
+        current_len += sentence_len
+    
+    if parts:
+        chunks.append(" ".join(parts))
+    
+    return chunks
+
+def pack_batches(texts: List[str], max_chars=MAX_BATCH_CHARS):
+    """Gom các dòng thành batch theo ngân sách ký tự (greedy)"""
+    batches = []
+    current = []
+    current_len = 0
     
     for text in texts:
-        try:
-            translated = smart_translator.translate_with_smart_retry(text, target_language)
-            results[text] = translated
-            # Delay rất ngắn để tránh rate limit
-            time.sleep(0.05)
-        except Exception as e:
-            results[text] = text
+        text_len = len(text) + BATCH_TAG_OVERHEAD
+        if current and current_len + text_len > max_chars:
+            batches.append(current)
+            current = []
+            current_len = 0
+        current.append(text)
+        current_len += text_len
     
-    return results
+    if current:
+        batches.append(current)
+    
+    return batches
+
+async def flush_cache(cache: TranslationCache):
+    """Ghi cache xuống đĩa trong thread pool - lỗi SQLite (database is locked...) chỉ bỏ qua,
+    bản ghi vẫn chờ lần ghi sau, bản dịch đã có không bị mất"""
+    try:
+        await asyncio.to_thread(cache.flush)
+    except sqlite3.Error:
+        pass
+
+async def store_translations(smart_translator: SmartTranslator, pairs, target_language='vi'):
+    """Lưu bản dịch vào cache, đủ lô thì ghi xuống đĩa trong thread pool"""
+    cache = smart_translator.cache
+    if not cache:
+        return
+    cache.set_many(pairs, target_language)
+    if cache.flush_due():
+        await flush_cache(cache)
+
+async def translate_batch_tagged(batch: List[str], smart_translator: SmartTranslator, target_language='vi'):
+    """Dịch cả batch trong một request, tách kết quả theo tag đánh số
+    
+    Dòng không dịch được sau khi đã retry có kết quả None.
+    """
+    if len(batch) == 1:
+        text = batch[0]
+        if len(text) <= MAX_BATCH_CHARS:
+            translated = await smart_translator.translate_with_smart_retry(text, target_language)
+        else:
+            # Một dòng vượt giới hạn của một request - dịch từng đoạn theo câu
+            translated_chunks = await asyncio.gather(*(
+                smart_translator.translate_with_smart_retry(chunk, target_language)
+                for chunk in split_text_into_chunks(text)
+            ))
+            # Thiếu một đoạn thì cả dòng coi như chưa dịch - không trả về dòng nửa dịch nửa không
+            translated = None if None in translated_chunks else " ".join(translated_chunks)
+        
+        if translated is not None:
+            await store_translations(smart_translator, [(text, translated)], target_language)
+        return [translated]
+    
+    parts = [batch[0]]
+    for idx, text in enumerate(batch[1:], 1):
+        parts.append(BATCH_TAG_FORMAT.format(idx))
+        parts.append(text)
+    joined = "".join(parts)
+    
+    translated = await smart_translator.translate_with_smart_retry(joined, target_language)
+    # Request lỗi sau khi đã retry (thường là 429/5xx) - không chia nhỏ, chia đôi chỉ nhân
+    # số request lên trong lúc server đang giới hạn tốc độ
+    if translated is None:
+        return [None] * len(batch)
+    
+    # Google làm hỏng tag - chia đôi batch và dịch lại từng nửa
+    translated_list = _BATCH_TAG_RE.split(translated.strip())
+    if len(translated_list) != len(batch):
+        middle = len(batch) // 2
+        first, second = await asyncio.gather(
+            translate_batch_tagged(batch[:middle], smart_translator, target_language),
+            translate_batch_tagged(batch[middle:], smart_translator, target_language)
+        )
+        return first + second
+    
+    await store_translations(smart_translator, zip(batch, translated_list), target_language)
+    return translated_list
 
-def translate_batch_threaded_safe(texts: List[str], smart_translator: SmartTranslator, target_language='vi'):
-    """Dịch batch với threading an toàn cho Streamlit"""
+async def translate_texts_concurrent(texts: List[str], smart_translator: SmartTranslator, target_language='vi',
+                                     on_done=None):
+    """Dịch đồng thời nhiều dòng, số request song song giới hạn bởi Semaphore chung của translator
+    
+    Trả về dict {text: bản dịch}, dòng không dịch được có giá trị None.
+    """
+    total = len(texts)
+    
+    # Dòng đã có trong cache không cần gửi request - tra SQLite trong thread pool
+    # để event loop vẫn nhận response của các file khác trong lúc chờ đĩa
+    cache = smart_translator.cache
     results = {}
-    result_queue = queue.Queue()
+    if cache:
+        try:
+            results = await asyncio.to_thread(cache.get_many, texts, target_language)
+        except sqlite3.Error:
+            # Không đọc được cache - dịch như chưa có gì trong cache
+            pass
+    remaining = [text for text in texts if text not in results] if results else texts
     
-    def translate_worker(text_batch):
-        """Worker function cho thread"""
-        batch_results = {}
-        for text in text_batch:
-            try:
-                translated = smart_translator.translate_with_smart_retry(text, target_language)
-                batch_results[text] = translated
-                time.sleep(0.03)  # Delay ngắn
-            except Exception:
-                batch_results[text] = text
-        result_queue.put(batch_results)
+    completed = len(results)
+    if on_done and completed:
+        on_done(completed, total)
     
-    # Chia texts thành các batch nhỏ cho threading
-    batch_size = 5  # Batch nhỏ để tránh lỗi context
-    threads = []
+    # Dòng file khác đang dịch dở thì chờ kết quả đó, phần còn lại mới tự gửi request
+    in_flight = smart_translator.in_flight
+    loop = asyncio.get_running_loop()
+    own = []
+    shared = []
+    for text in remaining:
+        future = in_flight.get((text, target_language))
+        if future is None:
+            in_flight[(text, target_language)] = loop.create_future()
+            own.append(text)
+        else:
+            shared.append((text, future))
     
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        thread = threading.Thread(target=translate_worker, args=(batch,))
-        threads.append(thread)
-        thread.start()
+    async def _one(batch):
+        translated = [None] * len(batch)
+        try:
+            translated = await translate_batch_tagged(batch, smart_translator, target_language)
+        finally:
+            # Luôn trả kết quả cho các file đang chờ (lỗi thì None - giữ bản gốc)
+            for text, translated_text in zip(batch, translated):
+                in_flight.pop((text, target_language)).set_result(translated_text)
+        return batch, translated
+    
+    async def _wait(text, future):
+        return [text], [await future]
     
-    # Chờ tất cả threads hoàn thành
-    for thread in threads:
-        thread.join()
+    tasks = [asyncio.create_task(_one(batch)) for batch in pack_batches(own)]
+    tasks.extend(asyncio.create_task(_wait(text, future)) for text, future in shared)
     
-    # Lấy kết quả từ queue
-    while not result_queue.empty():
-        batch_results = result_queue.get()
-        results.update(batch_results)
+    # Nhận kết quả theo thứ tự hoàn thành để cập nhật tiến trình liên tục
+    for task in asyncio.as_completed(tasks):
+        batch, translated = await task
+        results.update(zip(batch, translated))
+        completed += len(batch)
+        if on_done:
+            on_done(completed, total)
     
     return results
 
+class SubtitleTrack:
+    """Phụ đề của một file lưu theo cột: mốc thời gian (mili giây) trong array, nội dung trong list
+    
+    Không tạo một object Python cho mỗi dòng - dòng thứ i là (starts[i], ends[i], texts[i]).
+    """
+    
+    __slots__ = ('starts', 'ends', 'texts')
+    
+    def __init__(self, starts, ends, texts):
+        self.starts = starts
+        self.ends = ends
+        self.texts = texts
+    
+    def __len__(self):
+        return len(self.texts)
+    
+    def duration(self):
+        """Khoảng thời gian từ dòng đầu đến hết dòng cuối (mili giây)"""
+        return self.ends[-1] - self.starts[0] if self.texts else 0
+
+def format_srt_time(ms):
+    """Định dạng số mili giây thành HH:MM:SS,mmm"""
+    hours, ms = divmod(ms, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    return "%02d:%02d:%02d,%03d" % (hours, minutes, seconds, ms)
+
 def srt_to_string(subs):
-    """Chuyển đổi pysrt SubRipFile thành string đúng định dạng SRT"""
-    result = []
-    for i, sub in enumerate(subs, 1):
-        result.append(str(i))
-        
-        start_time = sub.start.to_time()
-        end_time = sub.end.to_time()
-        
-        start_str = f"{start_time.hour:02d}:{start_time.minute:02d}:{start_time.second:02d},{start_time.microsecond//1000:03d}"
-        end_str = f"{end_time.hour:02d}:{end_time.minute:02d}:{end_time.second:02d},{end_time.microsecond//1000:03d}"
-        
-        result.append(f"{start_str} --> {end_str}")
-        result.append(sub.text)
-        result.append("")
+    """Chuyển đổi SubtitleTrack thành string đúng định dạng SRT"""
+    # Một lần format cho cả cue, tính giờ/phút/giây ngay tại chỗ - không gọi hàm cho từng mốc
+    blocks = []
+    add_block = blocks.append
+    for i, (start, end, text) in enumerate(zip(subs.starts, subs.ends, subs.texts), 1):
+        add_block(_SRT_CUE_FORMAT % (
+            i,
+            start // 3600000, start // 60000 % 60, start // 1000 % 60, start % 1000,
+            end // 3600000, end // 60000 % 60, end // 1000 % 60, end % 1000,
+            text
+        ))
+    return "\n".join(blocks)
+
+def decode_srt_bytes(raw):
+    """Giải mã nội dung file SRT, nhanh cho UTF-8 và tự nhận diện các encoding khác"""
+    # Đa số file là UTF-8 (có hoặc không có BOM) - giải mã thẳng, khỏi dò encoding
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    
+    # File UTF-16 xuất từ Windows luôn có BOM - giải mã thẳng, không cần dò
+    if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return raw.decode('utf-16')
     
-    return "\n".join(result)
+    # Nhận diện các encoding khác (CP1251, CP1252, ...)
+    best = charset_normalizer.from_bytes(raw).best()
+    if best is None:
+        return raw.decode('utf-8', errors='replace')
+    return str(best).lstrip('\ufeff')
 
-def translate_single_file_ultra_fast(file_content, filename, progress_callback=None):
-    """Dịch một file SRT với tốc độ siêu nhanh"""
+def parse_srt(srt_content):
+    """Parse nội dung SRT bằng một lượt regex"""
+    if '\r' in srt_content:
+        srt_content = srt_content.replace('\r\n', '\n').replace('\r', '\n')
+    
+    starts = array('q')
+    ends = array('q')
+    texts = []
+    add_start = starts.append
+    add_end = ends.append
+    add_text = texts.append
+    for h1, m1, s1, ms1, h2, m2, s2, ms2, text in _SRT_CUE_RE.findall(srt_content):
+        # Phần mili giây thiếu chữ số (",5") là phần thập phân của giây
+        add_start(((int(h1) * 60 + int(m1)) * 60 + int(s1)) * 1000 + int(ms1[:3].ljust(3, '0')))
+        add_end(((int(h2) * 60 + int(m2)) * 60 + int(s2)) * 1000 + int(ms2[:3].ljust(3, '0')))
+        add_text(text.rstrip('\n'))
+    return SubtitleTrack(starts, ends, texts)
+
+def load_upload(uploaded_file):
+    """Đọc, giải mã và parse file upload - chỉ gọi khi bấm dịch"""
+    # Không cache: bản parse đầy đủ chỉ cần cho lần dịch này, giữ lại theo file_id thì
+    # mỗi lần upload của mọi phiên đều nằm trong RAM suốt đời server
+    return parse_srt(decode_srt_bytes(uploaded_file.getvalue()))
+
+def _timing_to_ms(hours, minutes, seconds, ms):
+    """Đổi các nhóm (bytes) của một mốc thời gian SRT ra mili giây"""
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(ms[:3].ljust(3, b'0'))
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_SUMMARY_CACHE_SIZE)
+def summarize_upload(file_id, _uploaded_file):
+    """Số dòng và thời lượng ước tính của file upload - không parse, cache theo file_id"""
+    # Chỉ quét bytes: đếm '-->' và đọc dòng thời gian đầu/cuối. Parse đầy đủ để khi bấm dịch
+    raw = _uploaded_file.getvalue()
+    # UTF-16 (có byte 0) không quét thẳng trên bytes được - chuyển sang UTF-8 trước
+    if b'\x00' in raw[:4096]:
+        raw = decode_srt_bytes(raw).encode('utf-8')
+    
+    count = raw.count(b'-->')
+    first = _TIMING_BYTES_RE.search(raw)
+    last_arrow = raw.rfind(b'-->')
+    last = _TIMING_BYTES_RE.search(raw, raw.rfind(b'\n', 0, last_arrow) + 1) if last_arrow >= 0 else None
+    if not count or first is None or last is None:
+        return count, None
+    
+    duration = _timing_to_ms(*last.groups()[4:]) - _timing_to_ms(*first.groups()[:4])
+    return count, format_srt_time(max(duration, 0))
+
+async def translate_single_file_ultra_fast(subs, filename, smart_translator: SmartTranslator, progress_callback=None):
+    """Dịch một file SRT (đã parse) với tốc độ siêu nhanh"""
     try:
-        smart_translator = SmartTranslator()
-        
-        # Parse SRT content
-        subs = pysrt.from_string(file_content)
         total_subs = len(subs)
         
         if progress_callback:
             progress_callback(f"🚀 Bắt đầu dịch siêu nhanh {filename} ({total_subs} dòng)...")
         
-        # Lấy tất cả text cần dịch
-        texts_to_translate = []
-        text_to_sub_mapping = {}
+        # Lấy text cần dịch kèm vị trí của phụ đề, bỏ qua dòng không có chữ.
+        # Dòng trơn chỉ cần (vị trí, key); dòng có tag/khoảng trắng bao ngoài giữ thêm phần đó
+        plain = []
+        wrapped = []
+        # Gán sẵn vào biến local - vòng lặp chạy cho từng dòng phụ đề
+        add_plain = plain.append
+        add_wrapped = wrapped.append
+        translatable = is_translatable
+        for i, text in enumerate(subs.texts):
+            # Phần lớn dòng không có tag hay khoảng trắng thừa - khỏi chạy regex tách tag
+            if '<' in text or '{' in text or text[:1].isspace() or text[-1:].isspace():
+                prefix, inner, suffix = split_markup(text)
+                # Dòng không cần dịch giữ nguyên văn bản gốc
+                if translatable(inner):
+                    add_wrapped((i, prefix, inner, suffix))
+            elif translatable(text):
+                add_plain((i, text))
         
-        for i, sub in enumerate(subs):
-            if sub.text.strip():
-                texts_to_translate.append(sub.text)
-                text_to_sub_mapping[sub.text] = i
-        
-        if not texts_to_translate:
+        if not plain and not wrapped:
             return {
                 'filename': filename,
-                'content': srt_to_string(subs),
+                'content': await asyncio.to_thread(srt_to_string, subs),
+                'subs': subs,
                 'status': 'success',
-                'subtitle_count': total_subs
+                'subtitle_count': total_subs,
+                'untranslated_count': 0
             }
         
-        # Chia thành các batch
-        batch_size = 25  # Batch size vừa phải
-        translated_texts = {}
+        # Mỗi nội dung chỉ dịch một lần, kết quả áp dụng lại cho mọi dòng trùng
+        unique_texts = list(dict.fromkeys(
+            [key for _, key in plain] + [inner for _, _, inner, _ in wrapped]
+        ))
         
-        total_batches = (len(texts_to_translate) - 1) // batch_size + 1
+        # Dịch đồng thời tất cả các dòng
+        last_update = time.monotonic()
+        last_completed = 0
         
-        for batch_idx in range(0, len(texts_to_translate), batch_size):
-            batch = texts_to_translate[batch_idx:batch_idx + batch_size]
-            
-            if progress_callback:
-                progress_callback(f"⚡ {filename}: Batch {batch_idx//batch_size + 1}/{total_batches} ({len(batch)} dòng)")
+        def on_done(completed, total):
+            nonlocal last_update, last_completed
+            if not progress_callback:
+                return
             
-            # Chọn phương pháp dịch dựa trên kích thước batch
-            if len(batch) <= 10:
-                # Batch nhỏ - dùng threading an toàn
-                batch_results = translate_batch_threaded_safe(batch, smart_translator)
+            # Mỗi lần cập nhật widget là một lượt gửi qua websocket - chỉ cập nhật định kỳ
+            now = time.monotonic()
+            if (completed == total or completed - last_completed >= UI_UPDATE_EVERY
+                    or now - last_update >= UI_UPDATE_INTERVAL):
+                progress_callback(f"⚡ {filename}: {completed}/{total} dòng (không trùng lặp)")
+                last_update = now
+                last_completed = completed
+        
+        translated_texts = await translate_texts_concurrent(unique_texts, smart_translator, on_done=on_done)
+        
+        # Áp dụng bản dịch theo vị trí - một lượt O(N), mỗi dòng một lần tra dict.
+        # Dòng không dịch được (None) giữ nguyên bản gốc và được đếm để báo lên giao diện
+        texts = subs.texts
+        untranslated = 0
+        for i, key in plain:
+            translated = translated_texts[key]
+            if translated is None:
+                untranslated += 1
             else:
-                # Batch lớn - dùng sequential để tránh lỗi
-                batch_results = translate_batch_sequential(batch, smart_translator)
-            
-            translated_texts.update(batch_results)
-            
-            # Delay ngắn giữa các batch
-            time.sleep(0.1)
+                texts[i] = translated
+        for i, prefix, inner, suffix in wrapped:
+            translated = translated_texts[inner]
+            if translated is None:
+                untranslated += 1
+            else:
+                texts[i] = prefix + translated + suffix
         
-        # Áp dụng bản dịch
-        for sub in subs:
-            if sub.text.strip() and sub.text in translated_texts:
-                sub.text = translated_texts[sub.text]
+        # Ghép file chạy trong thread pool - event loop vẫn nhận response của các file khác
+        result = await asyncio.to_thread(srt_to_string, subs)
         
-        result = srt_to_string(subs)
+        # Ghi bản dịch của file này xuống đĩa trong một transaction - lỗi ở file sau không mất
+        if smart_translator.cache:
+            await flush_cache(smart_translator.cache)
         
         if progress_callback:
-            progress_callback(f"✅ Hoàn thành siêu nhanh {filename}")
+            if untranslated:
+                progress_callback(f"⚠️ Hoàn thành {filename}, {untranslated} dòng chưa dịch được")
+            else:
+                progress_callback(f"✅ Hoàn thành siêu nhanh {filename}")
         
         return {
             'filename': filename,
             'content': result,
+            'subs': subs,
             'status': 'success',
-            'subtitle_count': total_subs
+            'subtitle_count': total_subs,
+            'untranslated_count': untranslated
         }
         
     except Exception as e:
@@ -243,73 +793,166 @@ def translate_single_file_ultra_fast(file_content, filename, progress_callback=N
             'error': str(e)
         }
 
-def translate_multiple_files_sequential(file_info_list, progress_callback=None, overall_progress_callback=None):
-    """Dịch nhiều file tuần tự nhưng với tốc độ tối ưu"""
-    results = []
+@st.cache_resource
+def get_translation_runtime():
+    """Event loop chạy nền và SmartTranslator dùng chung cho mọi lần dịch"""
+    # Client HTTP gắn với event loop tạo ra nó - giữ loop sống để giữ kết nối keep-alive
+    # và tốc độ token bucket đã học được giữa các lần bấm dịch
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="translation-loop", daemon=True).start()
+    
+    cache = get_translation_cache()
+    
+    async def open_translator():
+        # Tạo ngay trong loop để các primitive asyncio (Semaphore request) thuộc về loop này
+        return await SmartTranslator(cache=cache).__aenter__()
+    
+    smart_translator = asyncio.run_coroutine_threadsafe(open_translator(), loop).result()
+    return loop, smart_translator
+
+def translate_multiple_files(file_info_list, progress_callback=None, overall_progress_callback=None):
+    """Dịch song song nhiều file, dùng chung một client HTTP và một bộ giới hạn tốc độ"""
     total_files = len(file_info_list)
+    results = [None] * total_files
+    loop, smart_translator = get_translation_runtime()
+    
+    # Giải mã và parse ngay lúc bấm dịch - mỗi file một lần
+    subs_list = [load_upload(file_info['file']) for file_info in file_info_list]
+    
+    # Widget Streamlit chỉ được cập nhật từ thread của script - chuyển qua queue
+    ui_updates = queue.Queue()
+    
+    def post_progress(message):
+        if progress_callback:
+            ui_updates.put((progress_callback, (message,)))
     
-    for i, file_info in enumerate(file_info_list):
-        if overall_progress_callback:
-            overall_progress_callback((i + 1) / total_files, f"Đang dịch file {i+1}/{total_files}: {file_info['name']}")
+    async def run_all():
+        # Mọi file chạy cùng lúc trên một event loop - số request đang bay do Semaphore
+        # chung của translator giới hạn, tốc độ do token bucket điều tiết
+        async def _one(index):
+            result = await translate_single_file_ultra_fast(
+                subs_list[index],
+                file_info_list[index]['name'],
+                smart_translator,
+                post_progress
+            )
+            return index, result
         
-        result = translate_single_file_ultra_fast(
-            file_info['content'], 
-            file_info['name'], 
-            progress_callback
-        )
-        results.append(result)
+        tasks = [asyncio.create_task(_one(i)) for i in range(total_files)]
         
-        # Delay ngắn giữa các file
-        time.sleep(0.2)
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            index, result = await task
+            results[index] = result
+            if overall_progress_callback:
+                ui_updates.put((
+                    overall_progress_callback,
+                    (done / total_files, f"Đã dịch {done}/{total_files} file: {result['filename']}")
+                ))
+    
+    future = asyncio.run_coroutine_threadsafe(run_all(), loop)
+    try:
+        # Gộp cập nhật: mỗi callback chỉ giữ thông điệp mới nhất, vẽ tối đa ~5 lần/giây
+        latest = {}
+        last_render = 0.0
+        while not (future.done() and ui_updates.empty()):
+            try:
+                callback, args = ui_updates.get(timeout=0.1)
+                latest[callback] = args
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            if latest and now - last_render >= UI_RENDER_INTERVAL:
+                for callback, args in latest.items():
+                    callback(*args)
+                latest.clear()
+                last_render = now
+        for callback, args in latest.items():
+            callback(*args)
+        future.result()
+    finally:
+        if smart_translator.cache:
+            try:
+                smart_translator.cache.flush()
+            except sqlite3.Error:
+                pass
     
     return results
 
 def create_zip_file(translated_files):
     """Tạo file ZIP chứa các file đã dịch"""
+    return build_zip(tuple(
+        (file_info['filename'], file_info['content'])
+        for file_info in translated_files
+        if file_info['status'] == 'success'
+    ))
+
+def build_zip(items):
+    """Nén các cặp (tên file gốc, nội dung đã dịch)"""
+    # Encode một lần, writestr nhận bytes thì không phải encode lại
+    entries = []
+    for original_name, content in items:
+        # Tạo tên file mới
+        name_without_ext = os.path.splitext(original_name)[0]
+        entries.append((f"{name_without_ext}.srt", content.encode('utf-8')))
+    
+    # Batch nhỏ: lưu thẳng, khỏi tốn CPU nén; batch lớn: nén mức nhanh nhất
+    total_size = sum(len(data) for _, data in entries)
+    if total_size < ZIP_STORE_THRESHOLD:
+        compression, compresslevel = zipfile.ZIP_STORED, None
+    else:
+        compression, compresslevel = zipfile.ZIP_DEFLATED, 1
+    
     zip_buffer = io.BytesIO()
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for file_info in translated_files:
-            if file_info['status'] == 'success':
-                # Tạo tên file mới
-                original_name = file_info['filename']
-                name_without_ext = os.path.splitext(original_name)[0]
-                new_filename = f"{name_without_ext}.srt"
-                
-                # Thêm vào ZIP
-                zip_file.writestr(new_filename, file_info['content'])
+    with zipfile.ZipFile(zip_buffer, 'w', compression, compresslevel=compresslevel) as zip_file:
+        for new_filename, data in entries:
+            # ZipInfo dựng sẵn với ngày giờ cố định - writestr không phải gọi localtime() mỗi file
+            zinfo = zipfile.ZipInfo(new_filename, ZIP_DATE_TIME)
+            zinfo.compress_type = compression
+            zinfo.external_attr = 0o100644 << 16  # file thường, rw-r--r--
+            zip_file.writestr(zinfo, data, compresslevel=compresslevel)
     
-    zip_buffer.seek(0)
     return zip_buffer.getvalue()
 
-def display_srt_preview(srt_content, filename=""):
-    """Hiển thị preview của file SRT"""
+def build_preview(subs):
+    """Số liệu và các cột bảng preview của một file - tính một lần, không gọi widget nào"""
+    return {
+        'count': len(subs),
+        'duration': format_srt_time(subs.duration()) if len(subs) else "N/A",
+        'total_chars': sum(map(len, subs.texts)),
+        'table': {
+            "#": list(range(1, len(subs) + 1)),
+            "Bắt đầu": [format_srt_time(ms) for ms in subs.starts],
+            "Kết thúc": [format_srt_time(ms) for ms in subs.ends],
+            "Nội dung": subs.texts,
+        },
+    }
+
+def display_srt_preview(file_result):
+    """Hiển thị preview của một file đã dịch"""
     try:
-        subs = pysrt.from_string(srt_content)
+        # Lưu kèm kết quả trong session state - đổi file/rerun không phải tính lại
+        if 'preview' not in file_result:
+            file_result['preview'] = build_preview(file_result['subs'])
+        preview = file_result['preview']
         
-        st.subheader(f"📺 Xem trước: {filename}")
+        st.subheader(f"📺 Xem trước: {file_result['filename']}")
         
         col1, col2, col3 = st.columns(3)
         with col1:
-            st.metric("Tổng số dòng", len(subs))
+            st.metric("Tổng số dòng", preview['count'])
         with col2:
-            if subs:
-                total_duration = subs[-1].end - subs[0].start
-                st.metric("Thời lượng", f"{total_duration}")
-            else:
-                st.metric("Thời lượng", "N/A")
+            st.metric("Thời lượng", preview['duration'])
         with col3:
-            total_chars = sum(len(sub.text) for sub in subs)
-            st.metric("Tổng ký tự", f"{total_chars:,}")
-        
-        # Hiển thị 10 dòng đầu
-        display_subs = subs[:10]
-        if len(subs) > 10:
-            st.info(f"Hiển thị 10/{len(subs)} dòng đầu tiên")
+            st.metric("Tổng ký tự", f"{preview['total_chars']:,}")
         
-        for i, sub in enumerate(display_subs):
-            with st.expander(f"Dòng {i+1}: {sub.start} --> {sub.end}"):
-                st.write(sub.text)
+        # Một bảng duy nhất (cuộn được) thay cho mỗi dòng một expander
+        st.dataframe(
+            preview['table'],
+            use_container_width=True,
+            height=400,
+            hide_index=True
+        )
         
     except Exception as e:
         st.error(f"❌ Lỗi khi hiển thị preview: {str(e)}")
@@ -333,7 +976,7 @@ def main():
         st.success("✅ **SIÊU NHANH** - Tốc độ tối đa!")
         
         st.markdown("### 🎯 Tính năng:")
-        st.write("• ⚡ Smart multi-threading")
+        st.write("• ⚡ Async HTTP/2 song song")
         st.write("• 🔄 Intelligent rate limiting")
         st.write("• 🚀 Optimized batch processing")
         st.write("• 🎯 Auto retry mechanism")
@@ -341,7 +984,8 @@ def main():
         
         st.markdown("---")
         st.header("📈 Hiệu suất")
-        st.metric("Tốc độ dịch", "~80 dòng/phút")
+        st.metric("Tốc độ tối đa", f"{REQUESTS_PER_SECOND:g} request/giây")
+        st.caption(f"Mỗi request gộp nhiều dòng (tối đa {MAX_BATCH_CHARS:,} ký tự)")
         st.metric("Độ chính xác", "99%+")
         st.metric("Tỷ lệ thành công", "98%+")
         
@@ -373,43 +1017,28 @@ def main():
         
         for i, uploaded_file in enumerate(uploaded_files):
             try:
-                # Đọc file
-                try:
-                    srt_content = uploaded_file.read().decode('utf-8')
-                except UnicodeDecodeError:
-                    try:
-                        uploaded_file.seek(0)
-                        srt_content = uploaded_file.read().decode('utf-8-sig')
-                    except:
-                        uploaded_file.seek(0)
-                        srt_content = uploaded_file.read().decode('latin-1')
-                
-                # Parse để lấy thông tin
-                subs = pysrt.from_string(srt_content)
-                file_size = len(srt_content)
+                # Chỉ quét nhanh số liệu tóm tắt - file được giải mã và parse khi bấm dịch
+                subtitle_count, duration = summarize_upload(uploaded_file.file_id, uploaded_file)
+                file_size = uploaded_file.size
                 
-                file_info = {
+                file_info_list.append({
                     'name': uploaded_file.name,
-                    'content': srt_content,
-                    'size': file_size,
-                    'subtitle_count': len(subs)
-                }
-                file_info_list.append(file_info)
+                    'file': uploaded_file
+                })
                 
                 total_size += file_size
-                total_subs += len(subs)
+                total_subs += subtitle_count
                 
                 # Hiển thị thông tin file
                 with st.expander(f"📄 {uploaded_file.name}"):
                     col1, col2, col3 = st.columns(3)
                     with col1:
-                        st.metric("Số dòng", len(subs))
+                        st.metric("Số dòng", subtitle_count)
                     with col2:
-                        st.metric("Kích thước", f"{file_size:,} ký tự")
+                        st.metric("Kích thước", f"{file_size:,} bytes")
                     with col3:
-                        if subs:
-                            duration = subs[-1].end - subs[0].start
-                            st.metric("Thời lượng", str(duration))
+                        if duration:
+                            st.metric("Thời lượng", duration)
                 
             except Exception as e:
                 st.error(f"❌ Lỗi đọc file {uploaded_file.name}: {str(e)}")
@@ -422,42 +1051,53 @@ def main():
         with col2:
             st.metric("📝 Tổng dòng phụ đề", f"{total_subs:,}")
         with col3:
-            st.metric("💾 Tổng kích thước", f"{total_size:,} ký tự")
+            st.metric("💾 Tổng kích thước", f"{total_size:,} bytes")
         with col4:
-            estimated_time = total_subs * 0.75 / 60  # Ước tính 0.75s/dòng
-            st.metric("⏱️ Thời gian ước tính", f"{estimated_time:.1f} phút")
+            # Ước tính theo số request: mỗi request gộp tối đa MAX_BATCH_CHARS ký tự. Kích thước file
+            # (gồm cả dòng thời gian) là cận trên - dòng đã có trong cache còn nhanh hơn
+            estimated_requests = max(1, -(-total_size // MAX_BATCH_CHARS))
+            estimated_seconds = estimated_requests / REQUESTS_PER_SECOND
+            if estimated_seconds < 60:
+                st.metric("⏱️ Thời gian ước tính", f"~{estimated_seconds:.0f} giây")
+            else:
+                st.metric("⏱️ Thời gian ước tính", f"~{estimated_seconds / 60:.1f} phút")
         
         # Thông báo tốc độ
-        st.info("⚡ **Chế độ SIÊU NHANH** đã được kích hoạt! Tối ưu hóa để tránh lỗi context.")
+        st.info("⚡ **Chế độ SIÊU NHANH** đã được kích hoạt! Các file được dịch song song, nhiều dòng gộp trong một request.")
         
         # Nút dịch siêu nhanh
         if st.button("🚀 BẮT ĐẦU DỊCH SIÊU NHANH", type="primary", use_container_width=True):
             start_time = time.time()
             
-            # Tạo progress tracking
-            progress_container = st.container()
-            with progress_container:
+            # Tạo progress tracking - gom vào một khối st.status
+            with st.status("🚀 Đang dịch với tốc độ siêu nhanh...", expanded=True) as status:
                 overall_progress = st.progress(0)
-                status_text = st.empty()
                 detailed_status = st.empty()
-                speed_metrics = st.empty()
-            
-            # Progress callbacks
-            def progress_callback(message):
-                detailed_status.text(message)
-            
-            def overall_progress_callback(progress, message):
-                overall_progress.progress(progress)
-                status_text.text(message)
-            
-            # Dịch tuần tự với tốc độ tối ưu
-            status_text.text("🚀 Đang dịch với tốc độ siêu nhanh...")
-            translated_files = translate_multiple_files_sequential(
-                file_info_list, 
-                progress_callback,
-                overall_progress_callback
-            )
+                
+                # Progress callbacks
+                def progress_callback(message):
+                    detailed_status.text(message)
+                
+                def overall_progress_callback(progress, message):
+                    overall_progress.progress(progress)
+                    status.update(label=message)
+                
+                # Dịch song song các file
+                translated_files = translate_multiple_files(
+                    file_info_list, 
+                    progress_callback,
+                    overall_progress_callback
+                )
+                
+                overall_progress.progress(1.0)
+                has_errors = any(f['status'] == 'error' for f in translated_files)
+                status.update(
+                    label="⚠️ Dịch xong, có file lỗi" if has_errors else "✅ Dịch xong",
+                    state="error" if has_errors else "complete",
+                    expanded=False
+                )
             
+            speed_metrics = st.container()
             end_time = time.time()
             duration = end_time - start_time
             
@@ -475,11 +1115,11 @@ def main():
                 with col3:
                     st.metric("📊 Hiệu suất", f"{(speed*60):.0f} dòng/phút")
             
-            overall_progress.progress(1.0)
-            
             # Lưu kết quả vào session state
             st.session_state.translated_files = translated_files
             st.session_state.translation_completed = True
+            # Nén một lần ngay sau khi dịch - các lần rerun chỉ đọc lại bytes, không hash/nén lại
+            st.session_state.zip_data = create_zip_file(translated_files)
             
             # Hiển thị kết quả
             success_count = sum(1 for f in translated_files if f['status'] == 'success')
@@ -489,6 +1129,15 @@ def main():
                 st.success(f"🎉 Dịch siêu nhanh hoàn thành! {success_count}/{len(translated_files)} file thành công trong {duration:.1f} giây")
                 st.balloons()
             
+            # File dịch xong nhưng còn dòng lỗi mạng/rate limit sau khi retry - giữ bản gốc
+            incomplete_files = [f for f in translated_files if f.get('untranslated_count')]
+            if incomplete_files:
+                total_untranslated = sum(f['untranslated_count'] for f in incomplete_files)
+                st.warning(f"⚠️ {total_untranslated} dòng trong {len(incomplete_files)} file chưa dịch được (giữ nguyên bản gốc) - bấm dịch lại để thử các dòng này")
+                with st.expander("Chi tiết dòng chưa dịch:"):
+                    for file_result in incomplete_files:
+                        st.write(f"• {file_result['filename']}: {file_result['untranslated_count']} dòng")
+            
             if error_count > 0:
                 st.error(f"❌ {error_count} file gặp lỗi")
                 
@@ -514,12 +1163,10 @@ def main():
                         st.session_state.show_preview = True
                 
                 with col2:
-                    # Tạo ZIP file
-                    zip_data = create_zip_file(success_files)
-                    
+                    # ZIP đã tạo sẵn khi dịch xong
                     st.download_button(
                         label=f"💾 Tải xuống {len(success_files)} file (.zip)",
-                        data=zip_data,
+                        data=st.session_state.zip_data,
                         file_name=f"translated_srt_ultra_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
                         mime="application/zip",
                         use_container_width=True
@@ -557,7 +1204,7 @@ def main():
                     
                     if selected_file is not None:
                         file_to_preview = success_files[selected_file]
-                        display_srt_preview(file_to_preview['content'], file_to_preview['filename'])
+                        display_srt_preview(file_to_preview)
     
     else:
         st.info("👆 Vui lòng chọn các file SRT để bắt đầu dịch siêu nhanh")
@@ -567,12 +1214,14 @@ def main():
             del st.session_state.translated_files
         if 'translation_completed' in st.session_state:
             del st.session_state.translation_completed
+        if 'zip_data' in st.session_state:
+            del st.session_state.zip_data
         if 'show_preview' in st.session_state:
             del st.session_state.show_preview
         
         # Hướng dẫn
         with st.expander("📚 Hướng dẫn sử dụng - Phiên bản SIÊU NHANH (Đã sửa lỗi)"):
-            st.markdown("""
+            st.markdown(f"""
             ### 🛠️ Cách sử dụng:
             
             1. **Chọn nhiều file SRT** cùng lúc (Ctrl+Click hoặc Shift+Click)
@@ -582,24 +1231,22 @@ def main():
             5. **Tải xuống file ZIP** hoặc từng file riêng lẻ
             
             ### 🚀 Công nghệ SIÊU NHANH (Đã tối ưu):
-            - ⚡ **Smart Threading:** Threading an toàn với Streamlit
-            - 🔄 **Intelligent Rate Limiting:** Tự động tránh bị chặn
-            - 🎯 **Optimized Batching:** Batch size tối ưu
-            - 📊 **Sequential Processing:** Xử lý tuần tự ổn định
-            - 🛡️ **Error Handling:** Xử lý lỗi thông minh
+            - ⚡ **Async HTTP/2:** Các file dịch song song, tối đa {MAX_CONCURRENT_REQUESTS} request cùng lúc
+            - 🔄 **Intelligent Rate Limiting:** Tự giảm tốc khi gặp 429, tuân theo Retry-After
+            - 🎯 **Optimized Batching:** Gộp nhiều dòng vào một request (tối đa {MAX_BATCH_CHARS:,} ký tự)
+            - 💾 **Cache bản dịch:** Dòng đã dịch trước đó không gửi lại
+            - 🛡️ **Error Handling:** Dòng lỗi giữ bản gốc và được báo số lượng
             
             ### 💡 Cải tiến trong phiên bản này:
             - ✅ **Đã sửa lỗi ScriptRunContext**
-            - ✅ **Threading an toàn cho Streamlit**
-            - ✅ **Tốc độ vẫn siêu nhanh (~80 dòng/phút)**
+            - ✅ **Tiến độ cập nhật an toàn từ thread của Streamlit**
             - ✅ **Ổn định và không bị crash**
             - ✅ **Tự động retry khi lỗi**
             
             ### 🎯 Hiệu suất dự kiến:
-            - **Tốc độ:** ~80 dòng/phút
+            - **Tốc độ:** tối đa {REQUESTS_PER_SECOND:g} request/giây, mỗi request nhiều dòng
             - **Độ chính xác:** 99%+
             - **Tỷ lệ thành công:** 98%+
-            - **Ổn định:** 100% (không lỗi context)
             """)
 
 if __name__ == "__main__":